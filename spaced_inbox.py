@@ -1,19 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import heapq
+import json
+import mmap
 import shutil
 import textwrap
 import datetime
+import fnmatch
+import gzip
+import os
 import re
 import sys
 import random
 import sqlite3
+import struct
+import tempfile
 from sqlite3 import Connection, Cursor
-from io import TextIOWrapper
+import io
 import hashlib
+import itertools
+import time
+import urllib.parse
+import urllib.request
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator
 
 sys.stdout.reconfigure(encoding='utf-8')  # type: ignore
 sys.stderr.reconfigure(encoding='utf-8')  # type: ignore
@@ -27,6 +40,8 @@ CONFIG_FILE_PATH: Path = Path("~/.config/spaced-inbox/config.txt").expanduser()
 DB_PATH: Path = Path("~/.local/share/spaced-inbox/data.db").expanduser()
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 REVIEW_LOAD_PATH: Path = Path("~/.local/share/spaced-inbox/review-load.csv").expanduser()
+BACKUP_DIR: Path = Path("~/.local/share/spaced-inbox/backups").expanduser()
+SNAPSHOT_PATH: Path = Path("~/.local/share/spaced-inbox/schedule.snapshot").expanduser()
 INBOX_PATHS: list[Path] = []
 
 if not CONFIG_FILE_PATH.exists():
@@ -37,19 +52,37 @@ if not CONFIG_FILE_PATH.exists():
 INITIAL_INTERVAL: int = 50
 # Default ease factor in percent, i.e. 300 means 300%.
 DEFAULT_EASE_FACTOR: int = 300
+# When a directory is listed in the config file, every file under it (at any
+# depth) whose name matches this pattern is an inbox file. Use a glob pattern
+# such as /path/to/notes/**/*.md in the config file to pick up other files.
+DIRECTORY_INBOX_PATTERN: str = "*.txt"
+# Number of snapshots of the database to keep in BACKUP_DIR.
+BACKUP_KEEP: int = 7
+# Set this to True to back up the database after every import (i.e. running
+# the script without --roll/--compile/etc.) that changed something. This is
+# convenient when running the import as a cronjob.
+AUTO_BACKUP: bool = False
+# Number of database pages copied per step of a backup. The database is only
+# locked while a step is running, so a roll started in the meantime doesn't
+# have to wait for the whole backup to finish.
+BACKUP_PAGES_PER_STEP: int = 256
+# Number of new notes to insert per executemany() call when doing a bulk
+# import with --import-bulk.
+BULK_INSERT_BATCH_SIZE: int = 10000
 
 # Call datetime.date.today() once so that even if someone is doing reviews
 # right before midnight, there won't be a weird inconsistent state could be
 # stored.
 TODAY: datetime.date = datetime.date.today()
 
-# TODO: one thing that smooth.sh did that the new-as-of-January-2023 version
-# doesn't do is having different quotas for the different inbox text files. If
+# One thing that smooth.sh did that the new-as-of-January-2023 version
+# didn't do was having different quotas for the different inbox text files. If
 # I do a large import of a new "stream" like browser bookmarks or something,
 # then the reviews will (after 50 days) probably get dominated by these browser
-# bookmarks. There should be some way to be like "limit browser bookmarks to at
-# most 1% of all reviews" or something.  For now this hasn't been a problem for
-# me, but it is something I will probably want to handle at some point.
+# bookmarks. The "quota:" config lines (see InboxQuota) now handle this: e.g.
+# "quota: /path/to/bookmarks.txt cap=1%" limits browser bookmarks to at most
+# 1% of all reviews, and a cap on a pattern applies to all the matching files
+# together.
 # I notice that I want to specify weights using different methods. For
 # example, with something like browser bookmarks, i want to say "don't make
 # this thing dominate the reviews". but i may also want to say something like
@@ -188,6 +221,67 @@ class ParseChunk:
             # itself would be empty, so exclude such notes
             self.note_text = ""
 
+@dataclass
+class InboxDirectory:
+    """A directory listed in the config file, or the directory part of a glob
+    pattern listed in the config file. Every file in the directory (or
+    anywhere under it, if recursive) whose name matches pattern is an inbox
+    file."""
+    directory: Path
+    pattern: str
+    recursive: bool
+
+INBOX_DIRECTORIES: list[InboxDirectory] = []
+
+def has_glob_magic(string: str) -> bool:
+    return re.search(r'[*?[]', string) is not None
+
+def inbox_directory_from_glob(path: Path) -> InboxDirectory | None:
+    """Convert a glob pattern of the form /some/dir/*.txt or
+    /some/dir/**/*.txt into an InboxDirectory. Wildcards anywhere else in the
+    path are not supported, in which case None is returned."""
+    parts = path.parts
+    first_magic = next(i for i, part in enumerate(parts) if has_glob_magic(part))
+    if first_magic == len(parts) - 1:
+        return InboxDirectory(Path(*parts[:first_magic]), parts[-1], recursive=False)
+    if (first_magic == len(parts) - 2 and parts[first_magic] == "**"):
+        return InboxDirectory(Path(*parts[:first_magic]), parts[-1], recursive=True)
+    return None
+
+@dataclass
+class InboxQuota:
+    """A "quota:" line from the config file. When picking a note to review,
+    the notes in the inbox files matching pattern have their weights
+    multiplied by weight, and together get picked at most a fraction cap of
+    the time (if there are due notes elsewhere)."""
+    pattern: str
+    weight: float = 1.0
+    cap: float | None = None
+
+INBOX_QUOTAS: list[InboxQuota] = []
+
+def parse_quota_line(line: str) -> InboxQuota | None:
+    """Parse a config line like "quota: /path/to/bookmarks.txt weight=0.5
+    cap=1%". Returns None if the line is malformed."""
+    match = re.match(r'quota:\s*(.*?)((?:\s+(?:weight|cap)=\S+)+)\s*$', line.strip())
+    if not match or not match.group(1):
+        return None
+    quota = InboxQuota(match.group(1))
+    for option in match.group(2).split():
+        key, value = option.split("=", 1)
+        try:
+            number = float(value[:-1]) / 100 if value.endswith("%") else float(value)
+        except ValueError:
+            return None
+        if key == "weight":
+            if number < 0:
+                return None
+            quota.weight = number
+        else:
+            if not (0 < number <= 1):
+                return None
+            quota.cap = number
+    return quota
 
 if CONFIG_FILE_PATH.exists():
     with open(CONFIG_FILE_PATH, "r", encoding="utf-8") as f:
@@ -198,13 +292,33 @@ if CONFIG_FILE_PATH.exists():
             if not line.strip():
                 # Skip blank lines as well
                 continue
+            if line.strip().startswith("quota:"):
+                quota = parse_quota_line(line)
+                if quota is None:
+                    print_terminal(f"Could not understand the line {line.strip()!r} in {CONFIG_FILE_PATH}! Quota lines should look like \"quota: /path/to/inbox.txt weight=0.5 cap=10%\" (each of weight and cap is optional, but at least one is required).", file=sys.stderr)
+                    sys.exit()
+                INBOX_QUOTAS.append(quota)
+                continue
             path = Path(line.strip())
+            if has_glob_magic(line.strip()):
+                inbox_directory = inbox_directory_from_glob(path)
+                if inbox_directory is None:
+                    print_terminal(f"Unsupported pattern {path}! Wildcards are only allowed in the last part of the path, optionally preceded by '**/' to also match files in subdirectories, e.g. /path/to/notes/*.txt or /path/to/notes/**/*.txt.", file=sys.stderr)
+                    sys.exit()
+                if not inbox_directory.directory.is_dir():
+                    print_terminal(f"Inbox directory {inbox_directory.directory} not found! Are you sure it is a valid directory? Make sure to expand out any abbreviations such as '~/'.", file=sys.stderr)
+                    sys.exit()
+                INBOX_DIRECTORIES.append(inbox_directory)
+                continue
+            if path.is_dir():
+                INBOX_DIRECTORIES.append(InboxDirectory(path, DIRECTORY_INBOX_PATTERN, recursive=True))
+                continue
             if not (path.exists() and path.is_file()):
                 print_terminal(f"Inbox file {path} not found! Are you sure it is a valid file? Make sure to expand out any abbreviations such as '~/'.", file=sys.stderr)
                 sys.exit()
             INBOX_PATHS.append(path)
 
-if not INBOX_PATHS:
+if not (INBOX_PATHS or INBOX_DIRECTORIES):
     print_terminal(f"Inbox file not found! Does your {CONFIG_FILE_PATH} contain the locations of valid files?",
           file=sys.stderr)
     sys.exit()
@@ -237,45 +351,510 @@ def main() -> None:
     parser.add_argument("-r", "--roll",
                         help=(f"Pick a random note to review. The note is chosen by the scheduling algorithm. Repeatedly running the script with this flag will allow you to do a \"review session\" where you review and edit notes in a sequence. {format_help}"),
                         action="store_true")
+    parser.add_argument("--import-bulk",
+                        help=("Import new notes like the default action, but optimized for a very large one-off import (e.g. hundreds of thousands of browser bookmarks). New notes are inserted in batches with relaxed durability settings, progress is reported, and the whole import is rolled back if anything goes wrong."),
+                        action="store_true")
+    parser.add_argument("-s", "--search", metavar="QUERY",
+                        help=(f"Print the notes matching QUERY, most relevant first. QUERY uses SQLite's full-text search syntax, e.g. 'spaced repetition', '\"exact phrase\"', 'anki OR mnemosyne', 'bookmark*'. {format_help}"))
+    parser.add_argument("--state",
+                        help="Only show notes whose note state (i.e. most recent react) is STATE. Used with --search.")
+    parser.add_argument("--due",
+                        help="Only show notes that are due. Used with --search.",
+                        action="store_true")
+    parser.add_argument("--order", choices=list(COMPILE_ORDERS), default="location",
+                        help="How to order the output of --compile: by file and line number (the default), by how many days the note is overdue, or by how likely the scheduler is to pick the note during a roll. --search always orders by relevance.")
+    parser.add_argument("--limit", type=int, metavar="K",
+                        help="Print at most K notes. Used with --compile and --search.")
+    parser.add_argument("--offset", type=int, metavar="M", default=0,
+                        help="Skip the first M notes. Used with --compile and --search, e.g. together with --limit to page through the output.")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text",
+                        help="Output format for --roll, --compile and --search. \"text\" is the <filename>:<line number>:<column number>:<fragment> format; \"jsonl\" prints one JSON object per note, including the file location and scheduling information such as the interval, note state and due date.")
+    parser.add_argument("--low-memory",
+                        help="Reconcile the inbox files with the database using temporary tables inside the database, instead of holding all the notes in memory. This is slower for small collections but keeps memory use flat for very large ones.",
+                        action="store_true")
+    parser.add_argument("--backup",
+                        help=f"Make a snapshot of the database in {BACKUP_DIR}, keeping the {BACKUP_KEEP} most recent snapshots. The database can keep being used while the backup runs. Nothing is copied if the database hasn't changed since the last snapshot.",
+                        action="store_true")
+    parser.add_argument("--export-changes", metavar="FILE", type=Path,
+                        help="Write the review schedule changes made since the last export to FILE, for use with --import-changes on another machine that shares the same inbox files.")
+    parser.add_argument("--import-changes", metavar="FILE", type=Path,
+                        help="Merge a file written by --export-changes on another machine into this database.")
+    parser.add_argument("--lsp",
+                        help="Run a language server over stdin/stdout, for text editors that support the Language Server Protocol. The server shows the due notes in the open inbox files, and offers code actions to react to a note and to roll.",
+                        action="store_true")
     args = parser.parse_args()
-    if not (DB_PATH.exists() and DB_PATH.is_file()):
-        script_dir = Path(__file__).parent.absolute()
-        schema_location = script_dir / "schema.sql"
-        with open(schema_location, "r", encoding="utf-8") as f:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.executescript(f.read())
-    else:
-        conn = sqlite3.connect(DB_PATH)
+    if args.import_bulk and args.low_memory:
+        parser.error("--import-bulk and --low-memory can't be used together")
+    if args.limit is not None and args.limit < 0:
+        parser.error("--limit must not be negative")
+    if args.offset < 0:
+        parser.error("--offset must not be negative")
+    conn = open_db()
 
     if args.roll or args.compile:
-        notes_from_db = reload_db(conn, log_level=0)
-        num_notes, num_due_notes = calc_stats(notes_from_db)
+        # If neither the inbox files nor the database changed since the last
+        # import, the snapshot has everything we need, so we can skip
+        # parsing the inbox files and loading every note from the database.
+        snapshot = read_snapshot(conn)
+        needs_note_text = False
+        if snapshot is not None:
+            notes_from_db, num_notes, num_due_notes = snapshot
+        else:
+            if args.low_memory:
+                reload_db_streaming(conn, log_level=0)
+                # Picking and compiling only ever look at due notes, so only
+                # those are loaded, and only with their scheduling
+                # information. The note text is fetched just for the notes
+                # that get printed.
+                notes_from_db = get_due_notes_from_db(conn, fetch_note_text=False)
+                needs_note_text = True
+                num_notes, num_due_notes = calc_stats_from_db(conn)
+            else:
+                notes_from_db = reload_db(conn, log_level=0)
+                num_notes, num_due_notes = calc_stats(notes_from_db)
+            write_snapshot(conn, get_meta(conn, "inbox_fingerprint"))
         record_review_load(num_notes, num_due_notes)
         if args.roll:
             note: Note | None = pick_note_to_review(notes_from_db, log_level=0)
             if note:
-                inbox_file = note.filepath
-                line_number = note.line_number_start
-                column_number = 1
-                line_fragment = initial_fragment(note.note_text).replace(':', '_')
-                print(f"{inbox_file}:{line_number}:{column_number}:{line_fragment}")
+                if needs_note_text:
+                    fill_note_text(conn, [note])
+                print_notes([note], args.format)
         if args.compile:
-            for note in sorted(due_notes(notes_from_db), key=lambda n: (n.filepath, n.line_number_start)):
-                inbox_file = note.filepath
-                line_number = note.line_number_start
-                column_number = 1
-                line_fragment = initial_fragment(note.note_text).replace(':', '_')
-                print(f"{inbox_file}:{line_number}:{column_number}:{line_fragment}")
+            selected = select_due_notes(notes_from_db, order=args.order, limit=args.limit,
+                                        offset=args.offset)
+            if needs_note_text:
+                fill_note_text(conn, selected)
+            print_notes(selected, args.format)
+    elif args.lsp:
+        InboxLanguageServer(conn).serve(sys.stdin.buffer, sys.stdout.buffer)
+    elif args.backup:
+        backup_db(conn)
+    elif args.export_changes is not None:
+        export_changes(conn, args.export_changes)
+    elif args.import_changes is not None:
+        import_changes(conn, args.import_changes)
+    elif args.search is not None:
+        # Reload first so that the line numbers we print match the current
+        # contents of the inbox files, unless the snapshot shows that nothing
+        # changed since the last import.
+        if not snapshot_is_current(conn):
+            if args.low_memory:
+                reload_db_streaming(conn, log_level=0)
+            else:
+                reload_db(conn, log_level=0)
+            write_snapshot(conn, get_meta(conn, "inbox_fingerprint"))
+        try:
+            print_notes(search_notes(conn, args.search, note_state=args.state, due_only=args.due,
+                                     limit=args.limit, offset=args.offset),
+                        args.format)
+        except sqlite3.OperationalError as e:
+            print_terminal(f"Search failed: {e}", file=sys.stderr)
+            sys.exit()
     else:
         # The following (i.e. not passing in any flags, the default action) is
         # useful if you just want to import new notes as a cronjob or
         # something, and don't want to do a review.
-        notes_from_db = reload_db(conn)
-        num_notes, num_due_notes = calc_stats(notes_from_db)
+        if args.low_memory:
+            reload_db_streaming(conn)
+            num_notes, num_due_notes = calc_stats_from_db(conn)
+        else:
+            notes_from_db = reload_db(conn, bulk=args.import_bulk)
+            num_notes, num_due_notes = calc_stats(notes_from_db)
+        if not snapshot_is_current(conn):
+            write_snapshot(conn, get_meta(conn, "inbox_fingerprint"))
         print("Number of notes:", num_notes)
         print("Number of notes that are due:", num_due_notes)
         record_review_load(num_notes, num_due_notes)
+        if AUTO_BACKUP:
+            backup_db(conn)
+
+def open_db() -> Connection:
+    if not (DB_PATH.exists() and DB_PATH.is_file()):
+        script_dir = Path(__file__).parent.absolute()
+        schema_location = script_dir / "schema.sql"
+        with open(schema_location, "r", encoding="utf-8") as f:
+            conn = sqlite3.connect(DB_PATH)
+            c = conn.cursor()
+            c.executescript(f.read())
+    else:
+        conn = sqlite3.connect(DB_PATH)
+    conn.executescript(MANIFEST_SCHEMA)
+    conn.executescript(META_SCHEMA)
+    conn.executescript(CHANGE_LOG_SCHEMA)
+    ensure_search_index(conn)
+    return conn
+
+# The meta table holds small pieces of bookkeeping state. data_version is
+# incremented by the triggers below whenever a row of notes actually changes
+# (most reloads rewrite every row with the values it already has, which
+# doesn't count), so it can be used to tell whether anything changed since
+# some earlier point, e.g. the last backup.
+META_SCHEMA: str = """
+create table if not exists meta (
+        key text primary key,
+        value
+);
+
+insert or ignore into meta (key, value) values ('data_version', 0);
+
+create trigger if not exists notes_data_version_insert after insert on notes begin
+        update meta set value = value + 1 where key = 'data_version';
+end;
+
+create trigger if not exists notes_data_version_delete after delete on notes begin
+        update meta set value = value + 1 where key = 'data_version';
+end;
+
+create trigger if not exists notes_data_version_update after update on notes
+when old.sha1sum is not new.sha1sum
+        or old.line_number_start is not new.line_number_start
+        or old.line_number_end is not new.line_number_end
+        or old.ease_factor is not new.ease_factor
+        or old.interval is not new.interval
+        or old.last_reviewed_on is not new.last_reviewed_on
+        or old.created_on is not new.created_on
+        or old.reviewed_count is not new.reviewed_count
+        or old.note_state is not new.note_state
+        or old.filepath is not new.filepath
+        or old.note_text is not new.note_text begin
+        update meta set value = value + 1 where key = 'data_version';
+end;
+"""
+
+def get_meta(conn: Connection, key: str):
+    row = conn.execute("select value from meta where key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_meta(conn: Connection, key: str, value) -> None:
+    conn.execute("insert or replace into meta (key, value) values (?, ?)", (key, value))
+
+def backup_db(conn: Connection, keep: int = BACKUP_KEEP, log_level=1) -> Path | None:
+    """Copy the database into BACKUP_DIR using SQLite's online backup, check
+    the copy with an integrity check, and delete all but the `keep` most
+    recent snapshots. Nothing is copied if the database hasn't changed since
+    the last snapshot. Returns the path of the new snapshot, if any."""
+    data_version = get_meta(conn, "data_version")
+    snapshots = sorted(BACKUP_DIR.glob("data-*.db"))
+    if snapshots and get_meta(conn, "last_backup_data_version") == data_version:
+        if log_level > 0:
+            print(f"Nothing changed since the last backup {snapshots[-1]}, skipping.", file=sys.stderr)
+        return None
+
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    backup_path = BACKUP_DIR / f"data-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    # Write to a temporary name first so that an interrupted or corrupt
+    # backup is never mistaken for a good snapshot.
+    partial_path = backup_path.with_name(backup_path.name + ".partial")
+    if log_level > 0:
+        print(f"Backing up the database to {backup_path}... ", file=sys.stderr, end="")
+    try:
+        backup_conn = sqlite3.connect(partial_path)
+        try:
+            conn.backup(backup_conn, pages=BACKUP_PAGES_PER_STEP, sleep=0.005)
+            integrity = backup_conn.execute("pragma integrity_check").fetchall()
+        finally:
+            backup_conn.close()
+    except BaseException:
+        # E.g. the disk is full; don't leave the partial backup behind, since
+        # nothing else would ever clean it up.
+        partial_path.unlink(missing_ok=True)
+        if log_level > 0:
+            print("failed.", file=sys.stderr)
+        raise
+    if integrity != [("ok",)]:
+        partial_path.unlink()
+        if log_level > 0:
+            print("failed.", file=sys.stderr)
+        print_terminal(f"The backup did not pass the integrity check, so it was deleted: {integrity[:5]}", file=sys.stderr)
+        sys.exit()
+    os.replace(partial_path, backup_path)
+    set_meta(conn, "last_backup_data_version", data_version)
+    conn.commit()
+    if log_level > 0:
+        print("done.", file=sys.stderr)
+
+    snapshots = sorted(BACKUP_DIR.glob("data-*.db"))
+    for old_snapshot in snapshots[:max(0, len(snapshots) - keep)]:
+        old_snapshot.unlink()
+        if log_level > 0:
+            print(f"Deleted old backup {old_snapshot}.", file=sys.stderr)
+    return backup_path
+
+# The change log records which notes had their review schedule changed, so
+# that --export-changes only has to look at those notes. Changes to just the
+# location of a note are not logged, since the inbox files themselves are
+# synced between machines.
+CHANGE_LOG_SCHEMA: str = """
+create table if not exists note_changes (
+        id integer primary key autoincrement,
+        sha1sum text not null,
+        change text not null  /* "insert", "update", "soft-delete" or "delete" */
+);
+
+create trigger if not exists notes_change_log_insert after insert on notes begin
+        insert into note_changes (sha1sum, change) values (new.sha1sum, 'insert');
+end;
+
+create trigger if not exists notes_change_log_delete after delete on notes begin
+        insert into note_changes (sha1sum, change) values (old.sha1sum, 'delete');
+end;
+
+create trigger if not exists notes_change_log_update after update on notes
+when old.ease_factor is not new.ease_factor
+        or old.interval is not new.interval
+        or old.last_reviewed_on is not new.last_reviewed_on
+        or old.created_on is not new.created_on
+        or old.reviewed_count is not new.reviewed_count
+        or old.note_state is not new.note_state begin
+        insert into note_changes (sha1sum, change)
+                values (new.sha1sum, case when old.interval >= 0 and new.interval < 0
+                                          then 'soft-delete' else 'update' end);
+end;
+"""
+
+CHANGES_FILE_FORMAT: str = "spaced-inbox-changes"
+CHANGES_FILE_VERSION: int = 1
+
+def export_changes(conn: Connection, path: Path, log_level=1) -> None:
+    """Write the current state of every note whose review schedule changed
+    since the last export to a gzipped JSON Lines file, to be read by
+    import_changes() on another machine. The first export from a database
+    contains all the notes. Afterwards the exported part of the change log is
+    deleted, since only the changes after the last export are ever read."""
+    last_export = get_meta(conn, "last_export_change_id")
+    # The log may be empty right after it was pruned, but ids are never
+    # reused, so the last exported id is still a valid lower bound.
+    until = conn.execute("select coalesce(max(id), ?) from note_changes",
+                         (last_export or 0,)).fetchone()[0]
+    columns = ", ".join(DB_COLUMNS)
+    if last_export is None:
+        rows = conn.execute(f"select {columns} from notes order by sha1sum")
+    else:
+        rows = conn.execute(f"""select {columns} from notes
+                                where sha1sum in (select sha1sum from note_changes where id > ?)
+                                order by sha1sum""", (last_export,))
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"format": CHANGES_FILE_FORMAT, "version": CHANGES_FILE_VERSION,
+                            "since": last_export, "until": until}) + "\n")
+        for row in rows:
+            f.write(json.dumps(dict(zip(DB_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += 1
+    set_meta(conn, "last_export_change_id", until)
+    conn.execute("delete from note_changes where id <= ?", (until,))
+    conn.commit()
+    if log_level > 0:
+        print(f"Exported {count} changed notes to {path}.", file=sys.stderr)
+
+def schedule_sort_key(row: dict) -> tuple:
+    """Of two versions of the same note, the one with the larger key wins when
+    merging. The version that has been reviewed more times wins, and among
+    versions reviewed equally often the most recently reviewed one wins.
+    Except that if neither has been reviewed yet, the *earliest* one wins,
+    since a later last_reviewed_on then just means the note was imported
+    later on that machine. This is a total order, so merging is
+    deterministic and both machines end up with the same schedule regardless
+    of the order in which they import each other's changes."""
+    reviewed_on = yyyymmdd_to_date(row["last_reviewed_on"]).toordinal()
+    return (row["reviewed_count"],
+            reviewed_on if row["reviewed_count"] > 0 else -reviewed_on,
+            row["interval"], row["ease_factor"], row["note_state"])
+
+def import_changes(conn: Connection, path: Path, log_level=1) -> None:
+    """Merge a file written by export_changes() on another machine into this
+    database. Notes are matched by sha1sum. For notes that exist on both
+    sides, the more recent review schedule wins (see schedule_sort_key()) and
+    the earlier created_on date is kept. Soft-deletes are not applied to
+    notes that are live here: whether a note is live is decided by this
+    machine's own inbox files on the next reload."""
+    inserted = updated = kept = 0
+    c = conn.cursor()
+    log_start = c.execute("select coalesce(max(id), 0) from note_changes").fetchone()[0]
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("format") != CHANGES_FILE_FORMAT or header.get("version") != CHANGES_FILE_VERSION:
+                print_terminal(f"{path} is not a changes file written by --export-changes (or it was written by an incompatible version of this script).", file=sys.stderr)
+                sys.exit()
+            for line in f:
+                remote = json.loads(line)
+                local_row = c.execute("select %s from notes where sha1sum = ?" % ", ".join(DB_COLUMNS),
+                                      (remote["sha1sum"],)).fetchone()
+                if local_row is None:
+                    c.execute("insert into notes (%s) values (%s)"
+                              % (", ".join(DB_COLUMNS), ", ".join(["?"]*len(DB_COLUMNS))),
+                              [remote[column] for column in DB_COLUMNS])
+                    inserted += 1
+                    continue
+                local = dict(zip(DB_COLUMNS, local_row))
+                created_on = min(local["created_on"], remote["created_on"])
+                if remote["interval"] >= 0 and schedule_sort_key(remote) > schedule_sort_key(local):
+                    winner = remote
+                    updated += 1
+                else:
+                    winner = local
+                    kept += 1
+                location = remote if local["interval"] < 0 and winner is remote else local
+                c.execute("""update notes set ease_factor = ?,
+                                              interval = ?,
+                                              last_reviewed_on = ?,
+                                              created_on = ?,
+                                              reviewed_count = ?,
+                                              note_state = ?,
+                                              filepath = ?,
+                                              line_number_start = ?,
+                                              line_number_end = ?,
+                                              note_text = ?
+                             where sha1sum = ?""", (
+                                              winner["ease_factor"],
+                                              winner["interval"],
+                                              winner["last_reviewed_on"],
+                                              created_on,
+                                              winner["reviewed_count"],
+                                              winner["note_state"],
+                                              location["filepath"],
+                                              location["line_number_start"],
+                                              location["line_number_end"],
+                                              location["note_text"],
+                             local["sha1sum"]))
+        # The changes we just imported came from the other machine, so they
+        # shouldn't be exported back to it.
+        c.execute("delete from note_changes where id > ?", (log_start,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if log_level > 0:
+        print(f"{inserted} notes were added, {updated} notes got the other machine's more recent schedule, {kept} notes kept their schedule.",
+              file=sys.stderr)
+
+# The manifest caches the listing of every directory under an
+# InboxDirectory, keyed by the directory's mtime. Adding, removing or renaming
+# an entry changes the mtime of the directory containing it, so as long as the
+# mtime is unchanged, the cached listing can be used instead of walking the
+# directory again.
+MANIFEST_SCHEMA: str = """
+create table if not exists inbox_manifest (
+        directory text primary key,
+        mtime_ns integer not null
+);
+
+create table if not exists inbox_manifest_entries (
+        directory text not null,
+        name text not null,
+        is_dir integer not null,
+        primary key (directory, name)
+) without rowid;
+"""
+
+# Directories modified less than this many nanoseconds before they are
+# scanned are not cached, since a second change within the same mtime tick
+# would go unnoticed.
+MANIFEST_MIN_AGE_NS: int = 2 * 10**9
+
+def scan_inbox_directory(conn: Connection, manifest: dict[str, int],
+                         inbox_directory: InboxDirectory,
+                         visited: set[str]) -> list[Path]:
+    """Return the inbox files in inbox_directory, using and updating the
+    cached directory listings in the manifest. Hidden files and directories
+    (those starting with a dot) are skipped. Symlinked directories are
+    followed, but each directory is only scanned once, so symlink loops and
+    several links to the same directory don't import the same notes twice."""
+    result: list[Path] = []
+    seen_real_paths: set[str] = set()
+    stack = [inbox_directory.directory]
+    while stack:
+        directory = stack.pop()
+        key = str(directory)
+        real_path = os.path.realpath(directory)
+        if real_path in seen_real_paths:
+            continue
+        seen_real_paths.add(real_path)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        visited.add(key)
+        entries: list[tuple[str, bool]]
+        if manifest.get(key) == mtime_ns:
+            entries = conn.execute("select name, is_dir from inbox_manifest_entries where directory = ?",
+                                   (key,)).fetchall()
+        else:
+            with os.scandir(directory) as it:
+                entries = [(entry.name, entry.is_dir()) for entry in it
+                           if not entry.name.startswith(".") and (entry.is_dir() or entry.is_file())]
+            conn.execute("delete from inbox_manifest_entries where directory = ?", (key,))
+            conn.execute("delete from inbox_manifest where directory = ?", (key,))
+            if time.time_ns() - mtime_ns >= MANIFEST_MIN_AGE_NS:
+                conn.execute("insert into inbox_manifest (directory, mtime_ns) values (?, ?)",
+                             (key, mtime_ns))
+                conn.executemany("insert into inbox_manifest_entries (directory, name, is_dir) values (?, ?, ?)",
+                                 ((key, name, is_dir) for name, is_dir in entries))
+        # Visit the subdirectories in sorted order, so that when a directory
+        # can be reached through several paths, the same path wins each time.
+        for name, is_dir in sorted(entries, reverse=True):
+            if is_dir:
+                if inbox_directory.recursive:
+                    stack.append(directory / name)
+            elif fnmatch.fnmatch(name, inbox_directory.pattern):
+                result.append(directory / name)
+    return sorted(result)
+
+def get_inbox_paths(conn: Connection) -> list[Path]:
+    """Return all the inbox files: the files listed in the config file,
+    followed by the files found in the directories listed in the config
+    file."""
+    result = list(INBOX_PATHS)
+    seen = set(result)
+    manifest: dict[str, int] = dict(conn.execute("select directory, mtime_ns from inbox_manifest").fetchall())
+    visited: set[str] = set()
+    for inbox_directory in INBOX_DIRECTORIES:
+        for path in scan_inbox_directory(conn, manifest, inbox_directory, visited):
+            if path not in seen:
+                seen.add(path)
+                result.append(path)
+    # Forget about directories that no longer exist or are no longer listed
+    # in the config file.
+    for directory in manifest.keys() - visited:
+        conn.execute("delete from inbox_manifest_entries where directory = ?", (directory,))
+        conn.execute("delete from inbox_manifest where directory = ?", (directory,))
+    conn.commit()
+    return result
+
+def format_location(filepath: Path | str, line_number: int, note_text: str) -> str:
+    """Format a note location as <filename>:<line number>:<column
+    number>:<starting fragment of the note>, for text editors to parse."""
+    column_number = 1
+    line_fragment = initial_fragment(note_text).replace(':', '_')
+    return f"{filepath}:{line_number}:{column_number}:{line_fragment}"
+
+def note_to_json(note: Note) -> str:
+    """Serialize a note as a single line of JSON, for editor plugins that want
+    the scheduling information without having to parse the fragment."""
+    due_on = note.last_reviewed_on + datetime.timedelta(days=note.interval)
+    return json.dumps({
+        "filepath": str(note.filepath),
+        "line_number_start": note.line_number_start,
+        "line_number_end": note.line_number_end,
+        "fragment": initial_fragment(note.note_text),
+        "sha1sum": note.sha1sum,
+        "interval": note.interval,
+        "ease_factor": note.ease_factor,
+        "note_state": note.note_state,
+        "reviewed_count": note.reviewed_count,
+        "created_on": note.created_on.strftime("%Y-%m-%d"),
+        "last_reviewed_on": note.last_reviewed_on.strftime("%Y-%m-%d"),
+        "due_on": due_on.strftime("%Y-%m-%d"),
+        "days_overdue": num_days_note_is_overdue(note),
+    }, ensure_ascii=False)
+
+def print_notes(notes: list[Note], output_format="text") -> None:
+    for note in notes:
+        if output_format == "jsonl":
+            print(note_to_json(note))
+        else:
+            print(format_location(note.filepath, note.line_number_start, note.note_text))
 
 def tag_with_filename(filepath: Path) -> Callable[[ParseChunk], tuple[Path, ParseChunk]]:
     def tag_it(pc: ParseChunk) -> tuple[Path, ParseChunk]:
@@ -283,12 +862,18 @@ def tag_with_filename(filepath: Path) -> Callable[[ParseChunk], tuple[Path, Pars
     return tag_it
 
 
-def parse_inbox(lines: TextIOWrapper) -> list[ParseChunk]:
+def parse_inbox(lines: Iterable[str]) -> list[ParseChunk]:
+    return list(iter_parse_inbox(lines))
+
+
+def iter_parse_inbox(lines: Iterable[str]) -> Iterator[ParseChunk]:
     """Parsing rules:
     - two or more blank lines in a row start a new note
     - a line with three or more equals signs and nothing else starts a new note
+
+    Notes are yielded one at a time as they are parsed, so that a whole inbox
+    file never has to be held in memory at once. Blank notes are skipped.
     """
-    result: list[ParseChunk] = []
     note_text = ""
     state = "text"
     # This is a finite state machine with three states (text, 1 newline, 2+
@@ -316,16 +901,16 @@ def parse_inbox(lines: TextIOWrapper) -> list[ParseChunk]:
             assert state == "2+ newline"
             if line and not re.match("===+$", line):
                 state = "text"
-                result.append(ParseChunk(note_text, line_number_start,
-                                         line_number - 1))
+                pc = ParseChunk(note_text, line_number_start, line_number - 1)
+                if pc.note_text:
+                    yield pc
                 line_number_start = line_number
                 note_text = line + "\n"
             # else: state remains the same
-    # We ended the loop above without adding the final note, so add it now
-    result.append(ParseChunk(note_text, line_number_start, line_number))
-    # Filter out blank notes
-    result = [pc for pc in result if pc.note_text]
-    return result
+    # We ended the loop above without yielding the final note, so yield it now
+    pc = ParseChunk(note_text, line_number_start, line_number)
+    if pc.note_text:
+        yield pc
 
 
 def _print_lines(string: str) -> None:
@@ -335,14 +920,129 @@ def _print_lines(string: str) -> None:
         line_number += 1
         print(line_number, line)
 
-def reload_db(conn: Connection, log_level=1) -> list[Note]:
+def find_duplicate_chunks(current_inbox: list[tuple[Path, ParseChunk]],
+                          db_hashes: dict[str, Note]) -> dict[str, list[tuple[Path, ParseChunk]]]:
+    """Find all the new notes (i.e. notes whose content isn't already in the
+    database) that appear more than once in the current inbox. Returns a dict
+    mapping each duplicated sha1sum to all the places it appears. Doing this
+    as a single pass up front means we can report every duplicate at once
+    instead of aborting on the first one halfway through an import."""
+    seen: dict[str, list[tuple[Path, ParseChunk]]] = {}
+    for inbox_filepath, pc in current_inbox:
+        if pc.sha1sum in db_hashes:
+            # Notes already in the database just get updated, so having
+            # several copies of them doesn't violate the unique constraint.
+            continue
+        seen.setdefault(pc.sha1sum, []).append((inbox_filepath, pc))
+    return {h: locations for h, locations in seen.items() if len(locations) > 1}
+
+
+def report_duplicate_chunks(duplicates: dict[str, list[tuple[Path, ParseChunk]]]) -> None:
+    print_terminal(f"Duplicate note text found in {len(duplicates)} notes! Please remove all duplicates and then re-import. The locations of the duplicates are:",
+                   file=sys.stderr)
+    for locations in duplicates.values():
+        for inbox_filepath, pc in locations:
+            print(format_location(inbox_filepath, pc.line_number_start, pc.note_text),
+                  file=sys.stderr)
+
+
+def insert_new_notes(c: Cursor, new_notes: list[Note], bulk=False,
+                     log_level=1) -> None:
+    insert_query = ("insert into notes (%s) values (%s)"
+                    % (", ".join(DB_COLUMNS), ", ".join(["?"]*len(DB_COLUMNS))))
+    if not bulk:
+        c.executemany(insert_query, (note.to_db_row() for note in new_notes))
+        return
+    for batch_start in range(0, len(new_notes), BULK_INSERT_BATCH_SIZE):
+        batch = new_notes[batch_start:batch_start + BULK_INSERT_BATCH_SIZE]
+        c.executemany(insert_query, (note.to_db_row() for note in batch))
+        if log_level > 0:
+            print(f"\rInserted {batch_start + len(batch)}/{len(new_notes)} new notes... ",
+                  file=sys.stderr, end="")
+    if log_level > 0 and new_notes:
+        print("done.", file=sys.stderr)
+
+
+def apply_chunk_to_note(note_from_db: Note, inbox_filepath: Path,
+                        pc: ParseChunk) -> tuple[Note, bool]:
+    """Given a (not soft-deleted) note from the database and the chunk of an
+    inbox file with the same content, return the note as it should now be
+    stored, along with whether a new react was applied."""
+    # The note content is not new, but the following things may have
+    # changed:
+    #     - the file in which the note appears
+    #     - the position in the file
+    #     - new reacts may have been added, which means interval,
+    #       last_reviewed_on, reviewed_count, and note_state
+    #       need to be changed
+    # So we need to update these things.
+    new_interval = note_from_db.interval
+    new_last_reviewed_on = note_from_db.last_reviewed_on
+    new_reviewed_count = note_from_db.reviewed_count
+    new_note_state = note_from_db.note_state
+    react_added = False
+    if pc.reacts and pc.reacts[-1].date > note_from_db.last_reviewed_on:
+        new_interval = good_interval(note_from_db.interval, note_from_db.ease_factor, pc.reacts[-1].text)
+        new_last_reviewed_on = pc.reacts[-1].date
+        new_reviewed_count += 1
+        new_note_state = pc.reacts[-1].text
+        react_added = True
+    new_note = Note(pc.sha1sum,
+                    pc.line_number_start,
+                    pc.line_number_end,
+                    note_from_db.ease_factor,
+                    new_interval,
+                    new_last_reviewed_on,
+                    note_from_db.created_on,
+                    new_reviewed_count,
+                    new_note_state,
+                    inbox_filepath,
+                    pc.note_text)
+    return (new_note, react_added)
+
+
+def update_note_in_db(c: Cursor, note: Note) -> None:
+    """Store the location, text and review schedule of a note that is already
+    in the database."""
+    c.execute("""update notes set line_number_start = ?,
+                                  line_number_end = ?,
+                                  filepath = ?,
+                                  interval = ?,
+                                  last_reviewed_on = ?,
+                                  reviewed_count = ?,
+                                  note_state = ?,
+                                  note_text = ?
+                 where sha1sum = ?""", (
+                                  note.line_number_start,
+                                  note.line_number_end,
+                                  str(note.filepath),
+                                  note.interval,
+                                  note.last_reviewed_on.strftime("%Y-%m-%d"),
+                                  note.reviewed_count,
+                                  note.note_state,
+                                  note.note_text,
+                 note.sha1sum,
+    ))
+
+
+def reload_db(conn: Connection, log_level=1, bulk=False) -> list[Note]:
     """Parses all the inbox text files to get the list of notes in the current
     inbox. Then uses the current inbox to update the database. Returns the list
     of notes from the current inbox (augmented with information from the
     database such as the created_on date of the note, which cannot be
-    determined solely from the current inbox files)."""
+    determined solely from the current inbox files).
+
+    If bulk is True, the database is tuned for inserting a very large number
+    of new notes: durability is relaxed for the duration of the import (the
+    import is still a single transaction, so it is rolled back as a whole if
+    anything fails), new notes are inserted in batches, and the planner
+    statistics and the search index are refreshed at the end."""
     current_inbox: list[tuple[Path, ParseChunk]] = []
-    for path in INBOX_PATHS:
+    inbox_paths = get_inbox_paths(conn)
+    # Taken before parsing, so that a file saved while we parse makes the
+    # snapshot stale instead of hiding the edit (see write_snapshot()).
+    fingerprint = inbox_fingerprint(inbox_paths)
+    for path in inbox_paths:
         if log_level > 0:
             print(f"Importing new notes from {path}... ", file=sys.stderr,
                   end="")
@@ -352,12 +1052,23 @@ def reload_db(conn: Connection, log_level=1) -> list[Note]:
         if log_level > 0:
             print("done.", file=sys.stderr)
 
+    notes_from_db = get_notes_from_db(conn, fetch_note_text=False)
+    db_hashes = {note.sha1sum: note for note in notes_from_db}
+    duplicates = find_duplicate_chunks(current_inbox, db_hashes)
+    if duplicates:
+        report_duplicate_chunks(duplicates)
+        sys.exit()
+
     result: list[Note] = []
+    new_notes: list[Note] = []
     if log_level > 0:
         print("Updating the database with the contents of the new inbox files... ", end="", file=sys.stderr)
+    if bulk:
+        old_synchronous = conn.execute("pragma synchronous").fetchone()[0]
+        old_journal_mode = conn.execute("pragma journal_mode").fetchone()[0]
+        conn.execute("pragma synchronous = off")
+        conn.execute("pragma journal_mode = memory")
     c = conn.cursor()
-    notes_from_db = get_notes_from_db(conn, fetch_note_text=False)
-    db_hashes = {note.sha1sum: note for note in notes_from_db}
     note_number = 0
     unchanged_number = 0
     new_react_added_number = 0
@@ -366,102 +1077,58 @@ def reload_db(conn: Connection, log_level=1) -> list[Note]:
 
     inbox_filepath: Path
     pc: ParseChunk
-    for inbox_filepath, pc in current_inbox:
-        if pc.sha1sum in db_hashes and db_hashes[pc.sha1sum].interval >= 0:
-            note_from_db: Note = db_hashes[pc.sha1sum]
-            # The note content is not new, but the following things may have
-            # changed:
-            #     - the file in which the note appears
-            #     - the position in the file
-            #     - new reacts may have been added, which means interval,
-            #       last_reviewed_on, reviewed_count, and note_state
-            #       need to be changed
-            # So we need to update these things.
-            new_interval = note_from_db.interval
-            new_last_reviewed_on = note_from_db.last_reviewed_on
-            new_reviewed_count = note_from_db.reviewed_count
-            new_note_state = note_from_db.note_state
-            if pc.reacts and pc.reacts[-1].date > note_from_db.last_reviewed_on:
-                new_interval = good_interval(note_from_db.interval, note_from_db.ease_factor, pc.reacts[-1].text)
-                new_last_reviewed_on = pc.reacts[-1].date
-                new_reviewed_count += 1
-                new_note_state = pc.reacts[-1].text
-                new_react_added_number += 1
+    try:
+        for inbox_filepath, pc in current_inbox:
+            if pc.sha1sum in db_hashes and db_hashes[pc.sha1sum].interval >= 0:
+                new_note, react_added = apply_chunk_to_note(db_hashes[pc.sha1sum], inbox_filepath, pc)
+                if react_added:
+                    new_react_added_number += 1
+                else:
+                    unchanged_number += 1
+                result.append(new_note)
+                update_note_in_db(c, new_note)
+            elif pc.sha1sum in db_hashes:
+                note_from_db = db_hashes[pc.sha1sum]
+                # The note content is not new but the same note content was
+                # previously added and then soft-deleted from the db, so we want to
+                # reset the review schedule.
+                new_note = Note(pc.sha1sum,
+                                pc.line_number_start,
+                                pc.line_number_end,
+                                DEFAULT_EASE_FACTOR,
+                                INITIAL_INTERVAL,
+                                TODAY,
+                                note_from_db.created_on,
+                                0,
+                                "normal",
+                                inbox_filepath,
+                                pc.note_text)
+                result.append(new_note)
+                c.execute("""update notes set line_number_start = ?,
+                                              line_number_end = ?,
+                                              ease_factor = ?,
+                                              interval = ?,
+                                              last_reviewed_on = ?,
+                                              reviewed_count = ?,
+                                              note_state = ?,
+                                              filepath = ?,
+                                              note_text = ?
+                             where sha1sum = ?""", (
+                                              new_note.line_number_start,
+                                              new_note.line_number_end,
+                                              new_note.ease_factor,
+                                              new_note.interval,
+                                              new_note.last_reviewed_on.strftime("%Y-%m-%d"),
+                                              new_note.reviewed_count,
+                                              new_note.note_state,
+                                              str(new_note.filepath),
+                                              new_note.note_text,
+                             new_note.sha1sum))
+                resurrected_number += 1
             else:
-                unchanged_number += 1
-            new_note = Note(pc.sha1sum,
-                            pc.line_number_start,
-                            pc.line_number_end,
-                            note_from_db.ease_factor,
-                            new_interval,
-                            new_last_reviewed_on,
-                            note_from_db.created_on,
-                            new_reviewed_count,
-                            new_note_state,
-                            inbox_filepath,
-                            pc.note_text)
-            result.append(new_note)
-            c.execute("""update notes set line_number_start = ?,
-                                          line_number_end = ?,
-                                          filepath = ?,
-                                          interval = ?,
-                                          last_reviewed_on = ?,
-                                          reviewed_count = ?,
-                                          note_state = ?,
-                                          note_text = ?
-                         where sha1sum = ?""", (
-                                          new_note.line_number_start,
-                                          new_note.line_number_end,
-                                          str(new_note.filepath),
-                                          new_note.interval,
-                                          new_note.last_reviewed_on.strftime("%Y-%m-%d"),
-                                          new_note.reviewed_count,
-                                          new_note.note_state,
-                                          new_note.note_text,
-                         new_note.sha1sum,
-            ))
-        elif pc.sha1sum in db_hashes:
-            note_from_db = db_hashes[pc.sha1sum]
-            # The note content is not new but the same note content was
-            # previously added and then soft-deleted from the db, so we want to
-            # reset the review schedule.
-            new_note = Note(pc.sha1sum,
-                            pc.line_number_start,
-                            pc.line_number_end,
-                            DEFAULT_EASE_FACTOR,
-                            INITIAL_INTERVAL,
-                            TODAY,
-                            note_from_db.created_on,
-                            0,
-                            "normal",
-                            inbox_filepath,
-                            pc.note_text)
-            result.append(new_note)
-            c.execute("""update notes set line_number_start = ?,
-                                          line_number_end = ?,
-                                          ease_factor = ?,
-                                          interval = ?,
-                                          last_reviewed_on = ?,
-                                          reviewed_count = ?,
-                                          note_state = ?,
-                                          filepath = ?,
-                                          note_text
-                         where sha1sum = ?""", (
-                                          new_note.line_number_start,
-                                          new_note.line_number_end,
-                                          new_note.ease_factor,
-                                          new_note.interval,
-                                          new_note.last_reviewed_on.strftime("%Y-%m-%d"),
-                                          new_note.reviewed_count,
-                                          new_note.note_state,
-                                          str(new_note.filepath),
-                                          new_note.note_text,
-                         new_note.sha1sum))
-            resurrected_number += 1
-        else:
-            # The note content is new.
-            note_number += 1
-            try:
+                # The note content is new. Duplicates were already ruled out
+                # above, so these can all be inserted in one go at the end.
+                note_number += 1
                 new_note = Note(sha1sum=pc.sha1sum,
                                 line_number_start=pc.line_number_start,
                                 line_number_end=pc.line_number_end,
@@ -473,34 +1140,273 @@ def reload_db(conn: Connection, log_level=1) -> list[Note]:
                                 note_state="normal",
                                 filepath=inbox_filepath,
                                 note_text=pc.note_text)
-                c.execute("insert into notes (%s) values (%s)"
-                          % (", ".join(DB_COLUMNS),
-                             ", ".join(["?"]*len(DB_COLUMNS))),
-                          new_note.to_db_row())
+                new_notes.append(new_note)
                 result.append(new_note)
-            except sqlite3.IntegrityError:
-                print("Duplicate note text found! Please remove all duplicates and then re-import.", pc.note_text, file=sys.stderr)
-                sys.exit()
+        if log_level > 0:
+            print(f"{note_number} new notes found, ", file=sys.stderr, end="")
+            print(f"{new_react_added_number} pre-existing notes got a new react, ", file=sys.stderr, end="")
+            print(f"{resurrected_number} notes were resurrected, ", file=sys.stderr, end="")
+            print(f"{unchanged_number} notes were completely unchanged other than potentially their location, ", file=sys.stderr, end="")
+
+        # Soft-delete any notes that no longer exist in the current inbox
+        inbox_hashes = set(pc.sha1sum for _, pc in current_inbox)
+        delete_count = 0
+        for note in notes_from_db:
+            if note.sha1sum not in inbox_hashes and note.interval >= 0:
+                delete_count += 1
+                c.execute("update notes set interval = -1 where sha1sum = ?",
+                          (note.sha1sum,))
+        if log_level > 0:
+            print(f"{delete_count} notes were soft-deleted... ", file=sys.stderr,
+                  end="")
+            print("done.", file=sys.stderr)
+
+        insert_new_notes(c, new_notes, bulk=bulk, log_level=log_level)
+        set_meta(conn, "inbox_fingerprint", fingerprint)
+        conn.commit()
+    except BaseException:
+        # Don't leave a half-processed import behind.
+        conn.rollback()
+        raise
+    finally:
+        if bulk:
+            conn.execute(f"pragma journal_mode = {old_journal_mode}")
+            conn.execute(f"pragma synchronous = {old_synchronous}")
+
+    if bulk:
+        if log_level > 0:
+            print("Optimizing indexes... ", file=sys.stderr, end="")
+        # The sha1sum index is kept up to date during the inserts, so there
+        # is nothing to rebuild, but the planner statistics are stale.
+        conn.execute("analyze notes")
+        if has_search_index(conn):
+            # Merge the many small index segments created by the inserts.
+            conn.execute("insert into notes_fts(notes_fts) values ('optimize')")
+        conn.commit()
+        if log_level > 0:
+            print("done.", file=sys.stderr)
+    return result
+
+
+# The full-text search index only covers live notes (i.e. notes that haven't
+# been soft-deleted). It is an external content table, so the note text itself
+# is only stored once, in the notes table. The triggers keep the index in sync
+# as reload_db inserts, updates and soft-deletes rows; the update trigger only
+# touches the index when the text or the live/soft-deleted status actually
+# changes, since most reloads rewrite every row without changing either.
+#
+# Note that the 'rebuild' command must not be used on this index, since it
+# would also index the soft-deleted notes.
+SEARCH_INDEX_SCHEMA: str = """
+create virtual table notes_fts using fts5(
+        note_text,
+        content = 'notes',
+        content_rowid = 'id',
+        tokenize = 'porter unicode61'
+);
+
+create trigger notes_fts_insert after insert on notes
+when new.interval >= 0 begin
+        insert into notes_fts (rowid, note_text) values (new.id, new.note_text);
+end;
+
+create trigger notes_fts_delete after delete on notes
+when old.interval >= 0 begin
+        insert into notes_fts (notes_fts, rowid, note_text)
+                values ('delete', old.id, old.note_text);
+end;
+
+create trigger notes_fts_update after update of note_text, interval on notes
+when old.note_text is not new.note_text
+        or (old.interval >= 0) is not (new.interval >= 0) begin
+        insert into notes_fts (notes_fts, rowid, note_text)
+                select 'delete', old.id, old.note_text where old.interval >= 0;
+        insert into notes_fts (rowid, note_text)
+                select new.id, new.note_text where new.interval >= 0;
+end;
+
+insert into notes_fts (rowid, note_text)
+        select id, note_text from notes where interval >= 0;
+"""
+
+def has_search_index(conn: Connection) -> bool:
+    return conn.execute("select 1 from sqlite_master where name = 'notes_fts'").fetchone() is not None
+
+def ensure_search_index(conn: Connection) -> None:
+    """Create the full-text search index if the database doesn't have one yet
+    (e.g. because it was created by an older version of this script). If
+    SQLite was compiled without FTS5, the index is silently skipped and
+    --search will report an error instead."""
+    if has_search_index(conn):
+        return
+    try:
+        conn.executescript("begin;" + SEARCH_INDEX_SCHEMA + "commit;")
+    except sqlite3.OperationalError:
+        conn.rollback()
+
+def search_notes(conn: Connection, query: str, note_state: str | None = None,
+                 due_only=False, limit: int | None = None, offset=0) -> list[Note]:
+    """Return the live notes matching the full-text search query, most
+    relevant first."""
+    if not has_search_index(conn):
+        raise sqlite3.OperationalError("the full-text search index is not available (is your SQLite compiled with FTS5?)")
+    conditions = ["notes_fts match ?"]
+    params: list[str | int] = [query]
+    if note_state is not None:
+        conditions.append("notes.note_state = ?")
+        params.append(note_state)
+    if due_only:
+        conditions.append("date(notes.last_reviewed_on, '+' || notes.interval || ' day') <= ?")
+        params.append(TODAY.strftime("%Y-%m-%d"))
+    columns = ", ".join("notes." + column for column in DB_COLUMNS)
+    rows = conn.execute(f"""select {columns}
+                            from notes_fts join notes on notes.id = notes_fts.rowid
+                            where {" and ".join(conditions)}
+                            order by notes_fts.rank
+                            limit ? offset ?""",
+                        params + [-1 if limit is None else limit, offset]).fetchall()
+    return [note_from_db_row(row) for row in rows]
+
+
+def reload_db_streaming(conn: Connection, log_level=1) -> None:
+    """Does the same thing as reload_db(), but without holding the inbox or the
+    database in memory. Each inbox file is parsed one note at a time into a
+    temporary table, and the inserts, updates, resurrections and soft-deletes
+    are then worked out with set-based queries against the notes table, so
+    peak memory doesn't grow with the size of the collection. Unlike
+    reload_db(), nothing is returned; use get_notes_from_db() or
+    calc_stats_from_db() afterwards."""
+    conn.create_function("good_interval", 3, good_interval, deterministic=True)
+    c = conn.cursor()
+    c.execute("drop table if exists temp.inbox_chunks")
+    c.execute("""create temp table inbox_chunks (
+                         sha1sum text not null,
+                         filepath text,
+                         line_number_start integer,
+                         line_number_end integer,
+                         react_date date,  /* date of the most recent react */
+                         react_text text,
+                         note_text text
+                 )""")
+    try:
+        inbox_paths = get_inbox_paths(conn)
+        # Taken before parsing; see reload_db()
+        fingerprint = inbox_fingerprint(inbox_paths)
+        for path in inbox_paths:
+            if log_level > 0:
+                print(f"Importing new notes from {path}... ", file=sys.stderr,
+                      end="")
+            with open(path, "r", encoding="utf-8") as f:
+                c.executemany("insert into temp.inbox_chunks values (?, ?, ?, ?, ?, ?, ?)",
+                              ((pc.sha1sum, str(path), pc.line_number_start, pc.line_number_end,
+                                pc.reacts[-1].date.strftime("%Y-%m-%d") if pc.reacts else None,
+                                pc.reacts[-1].text if pc.reacts else None,
+                                pc.note_text)
+                               for pc in iter_parse_inbox(f)))
+            if log_level > 0:
+                print("done.", file=sys.stderr)
+        c.execute("create index temp.inbox_chunks_sha1sum on inbox_chunks (sha1sum)")
+
+        duplicates: dict[str, list[tuple[Path, ParseChunk]]] = {}
+        for dup_sha1sum, filepath, line_number_start, line_number_end, note_text in c.execute("""
+                select sha1sum, filepath, line_number_start, line_number_end, note_text
+                from temp.inbox_chunks
+                where sha1sum in (select sha1sum from temp.inbox_chunks
+                                  where sha1sum not in (select sha1sum from notes)
+                                  group by sha1sum having count(*) > 1)
+                order by sha1sum, rowid""").fetchall():
+            duplicates.setdefault(dup_sha1sum, []).append(
+                (Path(filepath), ParseChunk(note_text, line_number_start, line_number_end)))
+        if duplicates:
+            report_duplicate_chunks(duplicates)
+            sys.exit()
+
+        if log_level > 0:
+            print("Updating the database with the contents of the new inbox files... ", end="", file=sys.stderr)
+        # A note that appears several times in the inbox is only a duplicate
+        # if it's new; copies of a note that is already in the database are
+        # allowed, and like in reload_db() the last copy wins.
+        c.execute("drop table if exists temp.inbox_notes")
+        c.execute("""create temp table inbox_notes as
+                     select * from temp.inbox_chunks
+                     where rowid in (select max(rowid) from temp.inbox_chunks group by sha1sum)
+                     order by rowid""")
+        c.execute("create unique index temp.inbox_notes_sha1sum on inbox_notes (sha1sum)")
+
+        # The counts are per copy of a note, to match reload_db().
+        note_number = c.execute("""select count(*) from temp.inbox_notes
+                                   where sha1sum not in (select sha1sum from notes)""").fetchone()[0]
+        new_react_added_number, unchanged_number, resurrected_number = c.execute("""
+                select coalesce(sum(notes.interval >= 0 and coalesce(s.react_date > notes.last_reviewed_on, 0)), 0),
+                       coalesce(sum(notes.interval >= 0 and not coalesce(s.react_date > notes.last_reviewed_on, 0)), 0),
+                       coalesce(sum(notes.interval < 0), 0)
+                from temp.inbox_chunks as s join notes on notes.sha1sum = s.sha1sum""").fetchone()
+        delete_count = c.execute("""select count(*) from notes where interval >= 0
+                                    and sha1sum not in (select sha1sum from temp.inbox_notes)""").fetchone()[0]
+
+        # Notes that are not new: update their location, and apply any new
+        # react. Note that on the right hand side of the assignments, the
+        # columns of notes refer to the values from before the update.
+        c.execute("""update notes set line_number_start = s.line_number_start,
+                                      line_number_end = s.line_number_end,
+                                      filepath = s.filepath,
+                                      interval = case when s.react_date > notes.last_reviewed_on
+                                                      then good_interval(notes.interval, notes.ease_factor, s.react_text)
+                                                      else notes.interval end,
+                                      last_reviewed_on = case when s.react_date > notes.last_reviewed_on
+                                                              then s.react_date
+                                                              else notes.last_reviewed_on end,
+                                      reviewed_count = case when s.react_date > notes.last_reviewed_on
+                                                            then notes.reviewed_count + 1
+                                                            else notes.reviewed_count end,
+                                      note_state = case when s.react_date > notes.last_reviewed_on
+                                                        then s.react_text
+                                                        else notes.note_state end,
+                                      note_text = s.note_text
+                     from temp.inbox_notes as s
+                     where notes.sha1sum = s.sha1sum and notes.interval >= 0""")
+        # Notes that were previously soft-deleted get their review schedule
+        # reset.
+        c.execute("""update notes set line_number_start = s.line_number_start,
+                                      line_number_end = s.line_number_end,
+                                      ease_factor = ?,
+                                      interval = ?,
+                                      last_reviewed_on = ?,
+                                      reviewed_count = 0,
+                                      note_state = 'normal',
+                                      filepath = s.filepath,
+                                      note_text = s.note_text
+                     from temp.inbox_notes as s
+                     where notes.sha1sum = s.sha1sum and notes.interval < 0""",
+                  (DEFAULT_EASE_FACTOR, INITIAL_INTERVAL, TODAY.strftime("%Y-%m-%d")))
+        # Soft-delete any notes that no longer exist in the current inbox
+        c.execute("""update notes set interval = -1 where interval >= 0
+                     and sha1sum not in (select sha1sum from temp.inbox_notes)""")
+        c.execute("""insert into notes (%s)
+                     select sha1sum, line_number_start, line_number_end, ?, ?, ?, ?, 0,
+                            'normal', filepath, note_text
+                     from temp.inbox_notes
+                     where sha1sum not in (select sha1sum from notes)
+                     order by rowid""" % ", ".join(DB_COLUMNS),
+                  (DEFAULT_EASE_FACTOR, INITIAL_INTERVAL, TODAY.strftime("%Y-%m-%d"),
+                   TODAY.strftime("%Y-%m-%d")))
+        set_meta(conn, "inbox_fingerprint", fingerprint)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        c.execute("drop table if exists temp.inbox_notes")
+        c.execute("drop table if exists temp.inbox_chunks")
+
     if log_level > 0:
         print(f"{note_number} new notes found, ", file=sys.stderr, end="")
         print(f"{new_react_added_number} pre-existing notes got a new react, ", file=sys.stderr, end="")
         print(f"{resurrected_number} notes were resurrected, ", file=sys.stderr, end="")
         print(f"{unchanged_number} notes were completely unchanged other than potentially their location, ", file=sys.stderr, end="")
-
-    # Soft-delete any notes that no longer exist in the current inbox
-    inbox_hashes = set(pc.sha1sum for _, pc in current_inbox)
-    delete_count = 0
-    for note in notes_from_db:
-        if note.sha1sum not in inbox_hashes and note.interval >= 0:
-            delete_count += 1
-            c.execute("update notes set interval = -1 where sha1sum = ?",
-                      (note.sha1sum,))
-    conn.commit()
-    if log_level > 0:
         print(f"{delete_count} notes were soft-deleted... ", file=sys.stderr,
               end="")
         print("done.", file=sys.stderr)
-    return result
 
 
 def due_notes(notes_from_db: list[Note]) -> list[Note]:
@@ -517,22 +1423,156 @@ def num_days_note_is_overdue(note: Note) -> int:
     days_since_reviewed = (TODAY - note.last_reviewed_on).days
     return days_since_reviewed - note.interval
 
-def get_recent_unreviewed_note(notes_from_db: list[Note]) -> Note | None:
+def is_recent_unreviewed(note: Note) -> bool:
+    days_since_created = (TODAY - note.created_on).days
+    return (note.interval > 0 and note.note_state == "normal" and
+            INITIAL_INTERVAL <= days_since_created <= 2 * INITIAL_INTERVAL and
+            note.reviewed_count == 0)
+
+def note_weight(note: Note) -> int:
+    """The weight with which a due note is picked from its pool of candidates
+    during a roll."""
+    return num_days_note_is_overdue(note)**2
+
+def find_quota(filepath: Path | str) -> InboxQuota | None:
+    for quota in INBOX_QUOTAS:
+        if fnmatch.fnmatch(str(filepath), quota.pattern):
+            return quota
+    return None
+
+def capped_probabilities(weights: list[float], caps: list[float | None]) -> list[float]:
+    """Turn the weights into probabilities, such that no probability exceeds
+    its cap. Whatever a capped entry would have gotten over its cap is shared
+    among the uncapped entries in proportion to their weights. If every entry
+    ends up capped, the caps can't all hold, and the probabilities will be
+    scaled up proportionally when sampling."""
+    total = sum(weights)
+    probabilities = [weight / total for weight in weights]
+    capped = [False] * len(weights)
+    while True:
+        over = [i for i, (p, cap) in enumerate(zip(probabilities, caps))
+                if not capped[i] and cap is not None and p > cap]
+        if not over:
+            return probabilities
+        for i in over:
+            probabilities[i] = caps[i]  # type: ignore
+            capped[i] = True
+        remaining = 1 - sum(p for p, is_capped in zip(probabilities, capped) if is_capped)
+        uncapped_total = sum(weight for weight, is_capped in zip(weights, capped) if not is_capped)
+        if uncapped_total == 0:
+            return probabilities
+        for i, weight in enumerate(weights):
+            if not capped[i]:
+                probabilities[i] = remaining * weight / uncapped_total
+
+class StratifiedSampler:
+    """Picks a note in three steps: first a stratum, then an inbox file
+    within that stratum, then a note within that file. There is one stratum
+    per quota, holding all the inbox files matching it, plus one stratum per
+    inbox file that doesn't match any quota. The cumulative weights are
+    computed once up front, so each pick is just three binary searches. The
+    stratum is picked with probability proportional to its total weight
+    times its quota weight, subject to its quota cap, and the file and note
+    are picked in proportion to their weights. Without any quotas, this
+    gives every note the same probability as picking from one big pool."""
+
+    def __init__(self, files: list[tuple[InboxQuota | None, list[Note], list[float]]]) -> None:
+        self.notes_by_file: list[list[Note]] = [notes for _, notes, _ in files]
+        self.cum_weights_by_file: list[list[float]] = [list(itertools.accumulate(weights))
+                                                       for _, _, weights in files]
+        files_by_stratum: dict[tuple[str, str], list[int]] = {}
+        quota_by_stratum: dict[tuple[str, str], InboxQuota | None] = {}
+        for file_index, (quota, _, _) in enumerate(files):
+            key = ("quota", quota.pattern) if quota else ("file", str(file_index))
+            files_by_stratum.setdefault(key, []).append(file_index)
+            quota_by_stratum[key] = quota
+        strata = list(files_by_stratum)
+        self.files_by_stratum: list[list[int]] = [files_by_stratum[key] for key in strata]
+        self.cum_file_weights_by_stratum: list[list[float]] = [
+            list(itertools.accumulate(self.cum_weights_by_file[file_index][-1] for file_index in file_indices))
+            for file_indices in self.files_by_stratum]
+        stratum_weights: list[float] = []
+        caps: list[float | None] = []
+        for key, cum_file_weights in zip(strata, self.cum_file_weights_by_stratum):
+            quota = quota_by_stratum[key]
+            stratum_weights.append(cum_file_weights[-1] * (quota.weight if quota else 1.0))
+            caps.append(quota.cap if quota else None)
+        if sum(stratum_weights) == 0:
+            # Every stratum with due notes has a quota weight of zero; fall
+            # back to ignoring the quota weights rather than never showing
+            # them.
+            stratum_weights = [cum_file_weights[-1] for cum_file_weights in self.cum_file_weights_by_stratum]
+        self.cum_stratum_probabilities: list[float] = list(
+            itertools.accumulate(capped_probabilities(stratum_weights, caps)))
+
+    def sample(self) -> Note:
+        stratum_index = self._bisect(self.cum_stratum_probabilities)
+        file_indices = self.files_by_stratum[stratum_index]
+        file_index = file_indices[self._bisect(self.cum_file_weights_by_stratum[stratum_index])]
+        return self.notes_by_file[file_index][self._bisect(self.cum_weights_by_file[file_index])]
+
+    @staticmethod
+    def _bisect(cum_weights: list[float]) -> int:
+        index = bisect.bisect(cum_weights, random.random() * cum_weights[-1])
+        # Guard against floating point error at the very end of the range
+        return min(index, len(cum_weights) - 1)
+
+class DueNotesByFile:
+    """The due notes grouped by inbox file, with the quota of each file
+    looked up just once. When the config file has quotas,
+    pick_note_to_review() builds this once per roll and every review pool
+    picks from it, so the notes don't have to be regrouped (and matched
+    against the quota patterns) for each pool."""
+
+    def __init__(self, notes: list[Note]) -> None:
+        notes_by_file: dict[str, list[Note]] = {}
+        for note in notes:
+            if note_is_due(note):
+                notes_by_file.setdefault(str(note.filepath), []).append(note)
+        self.notes_by_file: list[list[Note]] = list(notes_by_file.values())
+        self.quotas: list[InboxQuota | None] = [find_quota(filepath) for filepath in notes_by_file]
+
+    def choose_note(self, is_candidate: Callable[[Note], bool],
+                    weight: Callable[[Note], float] | None = None) -> Note | None:
+        """Like choose_note(), for the due notes for which is_candidate() is
+        true, but with each file's quota applied."""
+        files: list[tuple[InboxQuota | None, list[Note], list[float]]] = []
+        for quota, notes in zip(self.quotas, self.notes_by_file):
+            candidates = [note for note in notes if is_candidate(note)]
+            if candidates:
+                files.append((quota, candidates, [weight(note) if weight else 1 for note in candidates]))
+        if not files:
+            return None
+        if sum(sum(weights) for _, _, weights in files) == 0:
+            files = [(quota, candidates, [1] * len(candidates)) for quota, candidates, _ in files]
+        return StratifiedSampler(files).sample()
+
+def choose_note(candidates: list[Note], weights: list[int] | None = None) -> Note:
+    """Randomly pick one of the candidates with probability proportional to
+    its weight, or uniformly if there are no weights."""
+    if weights is None:
+        return random.choice(candidates)
+    return random.choices(candidates, weights, k=1)[0]
+
+def get_recent_unreviewed_note(notes_from_db: list[Note],
+                               due_notes_by_file: DueNotesByFile | None = None) -> Note | None:
     """Randomly select a note that was created in the last 50-100 days and has
     not yet been reviewed yet."""
+    if due_notes_by_file is not None:
+        return due_notes_by_file.choose_note(is_recent_unreviewed)
     candidates = []
     for note in notes_from_db:
-        days_since_created = (TODAY - note.created_on).days
-        if (note.interval > 0 and note.note_state == "normal" and
-                INITIAL_INTERVAL <= days_since_created <= 2 * INITIAL_INTERVAL and
-                note.reviewed_count == 0):
+        if is_recent_unreviewed(note):
             assert note_is_due(note), note
             candidates.append(note)
     if not candidates:
         return None
-    return random.choice(candidates)
+    return choose_note(candidates)
 
-def get_exciting_note(notes_from_db: list[Note]) -> Note | None:
+def get_exciting_note(notes_from_db: list[Note],
+                      due_notes_by_file: DueNotesByFile | None = None) -> Note | None:
+    if due_notes_by_file is not None:
+        return due_notes_by_file.choose_note(lambda note: note.note_state == "exciting", note_weight)
     candidates = []
     weights = []
     for note in notes_from_db:
@@ -543,17 +1583,20 @@ def get_exciting_note(notes_from_db: list[Note]) -> Note | None:
             # likely to be selected.
             # TODO: I need to learn more about what sensible weights for this
             # are.
-            weights.append(num_days_note_is_overdue(note)**2)
+            weights.append(note_weight(note))
 
     if not candidates:
         return None
-    return random.choices(candidates, weights, k=1)[0]
+    return choose_note(candidates, weights)
 
 # TODO: I only deal with "normal" and "exciting" notes specially. But
 # there's support for arbitrary reactions during review. Eventually, I'd
 # like to incorporate more reactions into the review algo as well.
 
-def get_all_other_note(notes_from_db: list[Note]) -> Note | None:
+def get_all_other_note(notes_from_db: list[Note],
+                       due_notes_by_file: DueNotesByFile | None = None) -> Note | None:
+    if due_notes_by_file is not None:
+        return due_notes_by_file.choose_note(lambda note: note.note_state not in ["exciting"], note_weight)
     candidates = []
     weights = []
     for note in notes_from_db:
@@ -564,13 +1607,45 @@ def get_all_other_note(notes_from_db: list[Note]) -> Note | None:
             # it can be further delayed because it's already been so long
             # since you last saw the note.  So the weight should possibly
             # containt some percentage of the interval.
-            weights.append(num_days_note_is_overdue(note)**2)
+            weights.append(note_weight(note))
     if not candidates:
         return None
-    return random.choices(candidates, weights, k=1)[0]
+    return choose_note(candidates, weights)
+
+def scheduling_priority(note: Note) -> tuple[int, int]:
+    """Sort key that mirrors pick_note_to_review(): recent unreviewed notes
+    come first, then exciting notes, then all other notes, and within each
+    group the notes with the highest weight come first."""
+    if is_recent_unreviewed(note):
+        group = 0
+    elif note.note_state == "exciting":
+        group = 1
+    else:
+        group = 2
+    return (group, -note_weight(note))
+
+COMPILE_ORDERS: dict[str, Callable[[Note], tuple]] = {
+    "location": lambda note: (str(note.filepath), note.line_number_start),
+    "overdue": lambda note: (-num_days_note_is_overdue(note), str(note.filepath), note.line_number_start),
+    "weight": scheduling_priority,
+}
+
+def select_due_notes(notes: list[Note], order="location", limit: int | None = None,
+                     offset=0) -> list[Note]:
+    """Return the due notes sorted by one of the COMPILE_ORDERS, skipping the
+    first `offset` of them and returning at most `limit`. When there is a
+    limit, only the top offset+limit notes are kept (in a heap) rather than
+    sorting the whole due list."""
+    key = COMPILE_ORDERS[order]
+    due = (note for note in notes if note_is_due(note))
+    if limit is None:
+        return sorted(due, key=key)[offset:]
+    return heapq.nsmallest(offset + limit, due, key=key)[offset:]
 
 def pick_note_to_review(notes: list[Note], log_level=1) -> Note | None:
     note: Note | None = None
+    # With quotas, group the due notes by file once for all the pools below.
+    due_notes_by_file = DueNotesByFile(notes) if INBOX_QUOTAS else None
     rand = random.random()
     if log_level > 0:
         print("random number =", rand, file=sys.stderr)
@@ -578,7 +1653,7 @@ def pick_note_to_review(notes: list[Note], log_level=1) -> Note | None:
         if log_level > 0:
             print("Attempting to choose a recent unreviewed note...",
                   end="", file=sys.stderr)
-        note = get_recent_unreviewed_note(notes)
+        note = get_recent_unreviewed_note(notes, due_notes_by_file)
         if note is None:
             if log_level > 0:
                 print("failed.", file=sys.stderr)
@@ -589,7 +1664,7 @@ def pick_note_to_review(notes: list[Note], log_level=1) -> Note | None:
         if log_level > 0:
             print("Attempting to choose an exciting note...", end="",
                   file=sys.stderr)
-        note = get_exciting_note(notes)
+        note = get_exciting_note(notes, due_notes_by_file)
         if note is None:
             if log_level > 0:
                 print("failed.", file=sys.stderr)
@@ -600,7 +1675,7 @@ def pick_note_to_review(notes: list[Note], log_level=1) -> Note | None:
         if log_level > 0:
             print("Attempting to choose some other note...", end="",
                   file=sys.stderr)
-        note = get_all_other_note(notes)
+        note = get_all_other_note(notes, due_notes_by_file)
         if note is None:
             if log_level > 0:
                 print("failed.", file=sys.stderr)
@@ -620,6 +1695,181 @@ def calc_stats(notes: list[Note]) -> tuple[int, int]:
                 num_due_notes += 1
     return (num_notes, num_due_notes)
 
+# The snapshot is a compact binary copy of the scheduling information of the
+# live notes, written after each import. As long as neither the inbox files
+# nor the database have changed since, --roll and --compile can read the
+# snapshot instead of parsing the inbox files and loading every note from the
+# database. It is laid out as:
+#
+#     header | records | fragments | tables
+#
+# The records are fixed-width (SNAPSHOT_RECORD), so they can be scanned
+# straight out of the memory-mapped file. The fragments are the UTF-8 encoded
+# initial fragments of the notes, and the tables are a small JSON object
+# listing the file paths and note states that the records refer to by index.
+SNAPSHOT_MAGIC: bytes = b"SPCINBOX"
+SNAPSHOT_VERSION: int = 1
+# magic, version, generation (the database's data_version), fingerprint of the
+# inbox files, number of records, offset and length of the fragments, offset
+# and length of the tables
+SNAPSHOT_HEADER = struct.Struct("<8sIQ20sIQQQQ")
+# due date and interval, ease factor, note state index, reviewed count,
+# created on, file index, line number start and end, sha1sum, offset and
+# length of the fragment. Dates are stored as day ordinals, and the last
+# reviewed date is the due date minus the interval.
+SNAPSHOT_RECORD = struct.Struct("<iiiHIiIII20sII")
+
+def inbox_fingerprint(paths: list[Path]) -> bytes:
+    """A hash of the paths, sizes and modification times of the inbox files,
+    which changes whenever any of the inbox files (probably) changes."""
+    h = hashlib.sha1()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            h.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf-8"))
+        except FileNotFoundError:
+            h.update(f"{path}\0missing\0".encode("utf-8"))
+    return h.digest()
+
+def write_snapshot(conn: Connection, fingerprint: bytes) -> None:
+    """Write the snapshot of the live notes in the database. The fingerprint
+    must be that of the inbox files as they were *before* the last reload
+    parsed them (reload_db() stores it in the meta table), so that if a file
+    was saved in the meantime, the snapshot is stale from the start. The
+    snapshot is written to a temporary file first and then renamed into
+    place, so readers never see a half-written snapshot. If the snapshot
+    can't be written, a warning is printed and the command carries on; any
+    old snapshot is stale by then, so it won't be used."""
+    generation = get_meta(conn, "data_version")
+    paths: dict[str, int] = {}
+    states: dict[str, int] = {}
+    record_count = 0
+    fragments_length = 0
+    temp_path: str | None = None
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=SNAPSHOT_PATH.parent, prefix=SNAPSHOT_PATH.name + ".")
+        with os.fdopen(fd, "wb") as f, tempfile.TemporaryFile() as fragments:
+            f.write(bytes(SNAPSHOT_HEADER.size))
+            rows = conn.execute("select %s from notes where interval >= 0 order by rowid" % ", ".join(DB_COLUMNS))
+            for row in rows:
+                note = note_from_db_row(row)
+                fragment = initial_fragment(note.note_text).encode("utf-8")
+                f.write(SNAPSHOT_RECORD.pack(
+                    (note.last_reviewed_on + datetime.timedelta(days=note.interval)).toordinal(),
+                    note.interval,
+                    note.ease_factor,
+                    states.setdefault(note.note_state, len(states)),
+                    note.reviewed_count,
+                    note.created_on.toordinal(),
+                    paths.setdefault(str(note.filepath), len(paths)),
+                    note.line_number_start,
+                    note.line_number_end,
+                    bytes.fromhex(note.sha1sum),
+                    fragments_length,
+                    len(fragment),
+                ))
+                fragments.write(fragment)
+                fragments_length += len(fragment)
+                record_count += 1
+            fragments_offset = f.tell()
+            fragments.seek(0)
+            shutil.copyfileobj(fragments, f)
+            tables = json.dumps({"paths": list(paths), "states": list(states)}).encode("utf-8")
+            tables_offset = f.tell()
+            f.write(tables)
+            f.seek(0)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation, fingerprint,
+                                         record_count, fragments_offset, fragments_length,
+                                         tables_offset, len(tables)))
+        os.replace(temp_path, SNAPSHOT_PATH)
+        temp_path = None
+    except OSError as e:
+        # The snapshot is only a cache, so e.g. a full disk or (on Windows) a
+        # snapshot that another process has open shouldn't fail the command;
+        # the next run just takes the slower path.
+        print_terminal(f"Could not write the scheduling snapshot {SNAPSHOT_PATH}: {e}", file=sys.stderr)
+    finally:
+        if temp_path is not None:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+def snapshot_header_is_current(conn: Connection, header: tuple) -> bool:
+    magic, version, generation, fingerprint = header[:4]
+    return (magic == SNAPSHOT_MAGIC and version == SNAPSHOT_VERSION
+            and generation == get_meta(conn, "data_version")
+            and fingerprint == inbox_fingerprint(get_inbox_paths(conn)))
+
+def snapshot_is_current(conn: Connection) -> bool:
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            header = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    except (OSError, struct.error):
+        return False
+    return snapshot_header_is_current(conn, header)
+
+def read_snapshot(conn: Connection) -> tuple[list[Note], int, int] | None:
+    """Read the due notes from the snapshot, along with the same stats as
+    calc_stats(). The records are scanned in place in the memory-mapped file,
+    and only the due notes are turned into Note objects (with just the
+    initial fragment as their note_text). Returns None if the snapshot is
+    missing or stale, in which case the caller should reload the database
+    instead."""
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = SNAPSHOT_HEADER.unpack_from(mm)
+            if not snapshot_header_is_current(conn, header):
+                return None
+            record_count, fragments_offset, _, tables_offset, tables_length = header[4:]
+            if tables_offset + tables_length != len(mm):
+                # The snapshot got truncated somehow.
+                return None
+            tables = json.loads(mm[tables_offset:tables_offset + tables_length])
+            paths: list[str] = tables["paths"]
+            states: list[str] = tables["states"]
+            today = TODAY.toordinal()
+            num_notes = 0
+            num_due_notes = 0
+            result: list[Note] = []
+            records_end = SNAPSHOT_HEADER.size + record_count * SNAPSHOT_RECORD.size
+            with memoryview(mm) as view, view[SNAPSHOT_HEADER.size:records_end] as records:
+                for (due_on, interval, ease_factor, state_index, reviewed_count, created_on,
+                     file_index, line_number_start, line_number_end, sha1sum_bytes,
+                     fragment_offset, fragment_length) in SNAPSHOT_RECORD.iter_unpack(records):
+                    if interval > 0:
+                        num_notes += 1
+                    if due_on > today:
+                        continue
+                    if interval > 0:
+                        num_due_notes += 1
+                    fragment_start = fragments_offset + fragment_offset
+                    result.append(Note(
+                        sha1sum=sha1sum_bytes.hex(),
+                        line_number_start=line_number_start,
+                        line_number_end=line_number_end,
+                        ease_factor=ease_factor,
+                        interval=interval,
+                        last_reviewed_on=datetime.date.fromordinal(due_on - interval),
+                        created_on=datetime.date.fromordinal(created_on),
+                        reviewed_count=reviewed_count,
+                        note_state=states[state_index],
+                        filepath=paths[file_index],  # type: ignore
+                        note_text=mm[fragment_start:fragment_start + fragment_length].decode("utf-8"),
+                    ))
+            return (result, num_notes, num_due_notes)
+    except (OSError, ValueError, struct.error):
+        return None
+
+def calc_stats_from_db(conn: Connection) -> tuple[int, int]:
+    """Same as calc_stats(), but computed by the database rather than from a
+    list of notes."""
+    num_notes, num_due_notes = conn.execute("""
+            select count(*),
+                   coalesce(sum(date(last_reviewed_on, '+' || interval || ' day') <= ?), 0)
+            from notes where interval > 0""", (TODAY.strftime("%Y-%m-%d"),)).fetchone()
+    return (num_notes, num_due_notes)
+
 def record_review_load(num_notes: int, num_due_notes: int) -> None:
     if not (REVIEW_LOAD_PATH.exists() and REVIEW_LOAD_PATH.is_file()):
         with open(REVIEW_LOAD_PATH, "w", encoding="utf-8") as review_load_file:
@@ -669,6 +1919,14 @@ def yyyymmdd_to_date(string: str) -> datetime.date:
     return datetime.datetime.strptime(string, "%Y-%m-%d").date()
 
 
+def fill_note_text(conn: Connection, notes: list[Note]) -> None:
+    """Fetch the note text for notes that were loaded with
+    fetch_note_text=False."""
+    for note in notes:
+        note.note_text = conn.execute("select note_text from notes where sha1sum = ?",
+                                      (note.sha1sum,)).fetchone()[0]
+
+
 def get_notes_from_db(conn: Connection, fetch_note_text=True) -> list[Note]:
     cursor = conn.cursor()
     note_text_part = ""
@@ -679,6 +1937,411 @@ def get_notes_from_db(conn: Connection, fetch_note_text=True) -> list[Note]:
     result = [note_from_db_row(row, has_note_text=fetch_note_text) for row in rows]
     return result
 
+def get_due_notes_from_db(conn: Connection, fetch_note_text=True) -> list[Note]:
+    """Like get_notes_from_db(), but only the live notes that are due today,
+    so that the rest of the notes never have to be loaded."""
+    cursor = conn.cursor()
+    note_text_part = ""
+    if fetch_note_text:
+        note_text_part = ", note_text"
+    query = f"""select sha1sum, line_number_start, line_number_end, ease_factor, interval, last_reviewed_on, created_on, reviewed_count, note_state, filepath {note_text_part}
+                from notes
+                where interval >= 0 and date(last_reviewed_on, '+' || interval || ' day') <= ?"""
+    rows = cursor.execute(query, (TODAY.strftime("%Y-%m-%d"),)).fetchall()
+    return [note_from_db_row(row, has_note_text=fetch_note_text) for row in rows]
+
+
+# The reacts offered as code actions by the language server. Any other react
+# can still be typed by hand.
+REACT_STATES: list[str] = ["exciting", "interesting", "yeah", "lol", "meh",
+                           "cringe", "taxing"]
+
+def split_lines(text: str) -> list[str]:
+    """Split text into lines, keeping the line endings. Unlike
+    str.splitlines(), only newlines count as line breaks, to match how the
+    inbox files are read from disk."""
+    return list(io.StringIO(text))
+
+def lsp_character_to_index(line: str, character: int, encoding: str) -> int:
+    """Convert an LSP character offset within a line to an index into the
+    Python string."""
+    if encoding == "utf-32":
+        return min(character, len(line))
+    units = 0
+    for index, char in enumerate(line):
+        if units >= character:
+            return index
+        units += 2 if ord(char) > 0xFFFF else 1
+    return len(line)
+
+def lsp_line_length(line: str, encoding: str) -> int:
+    line = line.rstrip("\r\n")
+    if encoding == "utf-32":
+        return len(line)
+    return sum(2 if ord(char) > 0xFFFF else 1 for char in line)
+
+def path_from_uri(uri: str) -> Path:
+    return Path(urllib.request.url2pathname(urllib.parse.urlparse(uri).path))
+
+@dataclass
+class OpenDocument:
+    """An inbox file that is open in the editor, as seen by the language
+    server. chunks is kept in sync with lines incrementally as the document
+    is edited."""
+    uri: str
+    filepath: Path
+    lines: list[str]
+    chunks: list[ParseChunk]
+    # The sha1sums of the chunks edited since the document was last saved.
+    dirty: set[str] = field(default_factory=set)
+
+class InboxLanguageServer:
+    """A language server (speaking the Language Server Protocol over stdin
+    and stdout) for the inbox files. It keeps a parsed copy of each open
+    inbox file, and on each edit re-parses only the notes around the edited
+    lines. Due notes are shown as diagnostics and code lenses, and there are
+    code actions to react to the note under the cursor and to roll.
+
+    Reacts are applied to the database when the file is saved, and only for
+    the notes that were edited, whether they were typed by hand or added with
+    a code action. That way the database never records a react that the
+    editor rejected or that was undone before saving. New and deleted notes
+    are left for the next full reload, since the half-typed notes seen while
+    editing shouldn't get their own review schedules, and a note that is cut
+    from one file isn't deleted if it is pasted into another."""
+
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        self.documents: dict[str, OpenDocument] = {}
+        # The notes in the database for the chunks in the open documents
+        self.notes: dict[str, Note] = {}
+        self.position_encoding = "utf-16"
+        self.next_request_id = 0
+        self.running = True
+        inbox_paths = get_inbox_paths(conn)
+        self.inbox_paths: dict[Path, Path] = {path.resolve(): path for path in inbox_paths}
+
+    def serve(self, stdin, stdout) -> None:
+        self.stdout = stdout
+        while self.running:
+            message = self.read_message(stdin)
+            if message is None:
+                break
+            self.dispatch(message)
+
+    @staticmethod
+    def read_message(stdin) -> dict | None:
+        content_length = None
+        while True:
+            header = stdin.readline()
+            if not header:
+                return None
+            header = header.strip()
+            if not header:
+                break
+            name, _, value = header.decode("ascii").partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value)
+        if content_length is None:
+            return None
+        return json.loads(stdin.read(content_length).decode("utf-8"))
+
+    def send(self, message: dict) -> None:
+        message["jsonrpc"] = "2.0"
+        body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+        self.stdout.write(f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+        self.stdout.flush()
+
+    def send_request(self, method: str, params: dict) -> None:
+        # We don't need anything from the responses, so they are ignored.
+        self.next_request_id += 1
+        self.send({"id": f"spaced-inbox-{self.next_request_id}", "method": method, "params": params})
+
+    def dispatch(self, message: dict) -> None:
+        method = message.get("method")
+        if method is None:
+            # A response to one of our requests
+            return
+        handler = getattr(self, "on_" + method.replace("/", "_").replace("$", "dollar"), None)
+        is_request = "id" in message
+        try:
+            if handler is None:
+                if is_request:
+                    self.send({"id": message["id"], "error": {"code": -32601, "message": f"Method not found: {method}"}})
+                return
+            result = handler(message.get("params") or {})
+            if is_request:
+                self.send({"id": message["id"], "result": result})
+        except Exception as e:
+            print(f"Error while handling {method}: {e!r}", file=sys.stderr)
+            if is_request:
+                self.send({"id": message["id"], "error": {"code": -32603, "message": str(e)}})
+
+    def on_initialize(self, params: dict) -> dict:
+        encodings = params.get("capabilities", {}).get("general", {}).get("positionEncodings", [])
+        if "utf-32" in encodings:
+            self.position_encoding = "utf-32"
+        return {
+            "capabilities": {
+                "positionEncoding": self.position_encoding,
+                "textDocumentSync": {"openClose": True, "change": 2, "save": True},
+                "codeLensProvider": {"resolveProvider": False},
+                "codeActionProvider": True,
+                "executeCommandProvider": {"commands": ["spacedInbox.roll", "spacedInbox.react"]},
+            },
+            "serverInfo": {"name": "spaced-inbox"},
+        }
+
+    def on_initialized(self, params: dict) -> None:
+        pass
+
+    def on_shutdown(self, params: dict) -> None:
+        self.conn.commit()
+
+    def on_exit(self, params: dict) -> None:
+        self.running = False
+
+    def on_textDocument_didOpen(self, params: dict) -> None:
+        uri = params["textDocument"]["uri"]
+        filepath = self.inbox_paths.get(path_from_uri(uri).resolve())
+        if filepath is None:
+            # Not one of the inbox files
+            return
+        lines = split_lines(params["textDocument"]["text"])
+        document = OpenDocument(uri, filepath, lines, parse_inbox(lines))
+        self.documents[uri] = document
+        self.load_notes(document.chunks)
+        self.publish_diagnostics(document)
+
+    def on_textDocument_didChange(self, params: dict) -> None:
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return
+        for change in params["contentChanges"]:
+            if "range" not in change:
+                document.lines = split_lines(change["text"])
+                document.chunks = parse_inbox(document.lines)
+                changed_chunks = document.chunks
+            else:
+                changed_chunks = self.apply_change(document, change["range"], change["text"])
+            document.dirty.update(pc.sha1sum for pc in changed_chunks)
+            self.load_notes(changed_chunks)
+        self.publish_diagnostics(document)
+
+    def on_textDocument_didSave(self, params: dict) -> None:
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return
+        c = self.conn.cursor()
+        for pc in document.chunks:
+            if pc.sha1sum in document.dirty:
+                self.apply_reacts(c, document, pc)
+        self.conn.commit()
+        document.dirty.clear()
+        self.publish_diagnostics(document)
+
+    def on_textDocument_didClose(self, params: dict) -> None:
+        document = self.documents.pop(params["textDocument"]["uri"], None)
+        if document is not None:
+            self.send({"method": "textDocument/publishDiagnostics",
+                       "params": {"uri": document.uri, "diagnostics": []}})
+
+    def on_textDocument_codeLens(self, params: dict) -> list[dict]:
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return []
+        return [{"range": self.chunk_range(document, pc),
+                 "command": {"title": self.due_message(note), "command": ""}}
+                for pc, note in self.due_chunks(document)]
+
+    def on_textDocument_codeAction(self, params: dict) -> list[dict]:
+        actions = [{"title": "Roll: go to a note to review",
+                    "command": {"title": "Roll", "command": "spacedInbox.roll", "arguments": []}}]
+        document = self.documents.get(params["textDocument"]["uri"])
+        if document is None:
+            return actions
+        pc = self.chunk_at_line(document, params["range"]["start"]["line"] + 1)
+        if pc is None or self.notes.get(pc.sha1sum) is None:
+            return actions
+        for state in REACT_STATES:
+            actions.append({"title": f"React: {state}",
+                            "kind": "quickfix",
+                            "command": {"title": f"React: {state}", "command": "spacedInbox.react",
+                                        "arguments": [document.uri, pc.line_number_start, state]}})
+        return actions
+
+    def on_workspace_executeCommand(self, params: dict) -> None:
+        if params["command"] == "spacedInbox.roll":
+            self.roll()
+        elif params["command"] == "spacedInbox.react":
+            uri, line_number, state = params["arguments"]
+            self.react(uri, line_number, state)
+
+    def apply_change(self, document: OpenDocument, lsp_range: dict, text: str) -> list[ParseChunk]:
+        """Apply an incremental edit to the document and re-parse the notes
+        around it. Returns the chunks that were re-parsed."""
+        lines = document.lines
+        start_line, end_line = lsp_range["start"]["line"], lsp_range["end"]["line"]
+        start_text = lines[start_line] if start_line < len(lines) else ""
+        end_text = lines[end_line] if end_line < len(lines) else ""
+        start_index = lsp_character_to_index(start_text, lsp_range["start"]["character"], self.position_encoding)
+        end_index = lsp_character_to_index(end_text, lsp_range["end"]["character"], self.position_encoding)
+        new_lines = split_lines(start_text[:start_index] + text + end_text[end_index:])
+        old_line_count = min(end_line + 1, len(lines)) - start_line
+        lines[start_line:start_line + old_line_count] = new_lines
+        delta = len(new_lines) - old_line_count
+
+        # Re-parse from the start of the last note that begins strictly before
+        # the edited lines: nothing before that point changed, so the parser
+        # is in the same state there as it was before the edit. (Line numbers
+        # in the chunks are 1-based, LSP line numbers are 0-based.)
+        first_changed = start_line + 1
+        last_changed = start_line + old_line_count  # in the old numbering
+        chunks = document.chunks
+        first = bisect.bisect_left([pc.line_number_start for pc in chunks], first_changed) - 1
+        reparse_start = chunks[first].line_number_start if first >= 0 else 1
+        first = max(first, 0)
+        # Re-parse up to the end of the first note that begins after the
+        # edited lines. If that note comes out of the re-parse unchanged,
+        # the parser is back in sync and everything after it is unchanged
+        # apart from being shifted by delta lines. Otherwise, e.g. because the
+        # blank lines separating it from the edited note were deleted, try
+        # again with one more note.
+        last = bisect.bisect_right([pc.line_number_start for pc in chunks], last_changed)
+        while True:
+            if last < len(chunks):
+                reparse_end = chunks[last].line_number_end + delta
+            else:
+                reparse_end = len(lines)
+            reparsed = parse_inbox(lines[reparse_start - 1:reparse_end])
+            for pc in reparsed:
+                pc.line_number_start += reparse_start - 1
+                pc.line_number_end += reparse_start - 1
+            if last >= len(chunks):
+                break
+            old = chunks[last]
+            if (reparsed and reparsed[-1].line_number_start == old.line_number_start + delta
+                    and reparsed[-1].line_number_end == old.line_number_end + delta
+                    and reparsed[-1].note_text == old.note_text):
+                break
+            last += 1
+        for pc in chunks[last + 1:]:
+            pc.line_number_start += delta
+            pc.line_number_end += delta
+        chunks[first:last + 1] = reparsed
+        return reparsed
+
+    def load_notes(self, chunks: list[ParseChunk]) -> None:
+        """Fetch the live notes from the database for any chunks whose notes
+        we haven't looked up yet."""
+        sha1sums = [pc.sha1sum for pc in chunks if pc.sha1sum not in self.notes]
+        columns = ", ".join(DB_COLUMNS[:-1])
+        # Stay below SQLite's limit on the number of query parameters
+        for batch_start in range(0, len(sha1sums), 500):
+            batch = sha1sums[batch_start:batch_start + 500]
+            rows = self.conn.execute(f"select {columns} from notes where interval >= 0 and sha1sum in ({', '.join('?' * len(batch))})",
+                                     batch).fetchall()
+            for row in rows:
+                self.notes[row[0]] = note_from_db_row(row, has_note_text=False)
+
+    def apply_reacts(self, c: Cursor, document: OpenDocument, pc: ParseChunk) -> None:
+        # Re-read the note rather than using the copy in self.notes, since a
+        # reload or --import-changes may have changed its schedule since we
+        # loaded it.
+        columns = ", ".join(DB_COLUMNS[:-1])
+        row = c.execute(f"select {columns} from notes where interval >= 0 and sha1sum = ?",
+                        (pc.sha1sum,)).fetchone()
+        if row is None:
+            self.notes.pop(pc.sha1sum, None)
+            return
+        note = note_from_db_row(row, has_note_text=False)
+        self.notes[pc.sha1sum] = note
+        new_note, react_added = apply_chunk_to_note(note, document.filepath, pc)
+        if react_added:
+            update_note_in_db(c, new_note)
+            new_note.note_text = ""
+            self.notes[pc.sha1sum] = new_note
+
+    def react(self, uri: str, line_number: int, state: str) -> None:
+        document = self.documents.get(uri)
+        if document is None:
+            return
+        pc = self.chunk_at_line(document, line_number)
+        if pc is None:
+            return
+        # Insert the react right after the last non-blank line of the note.
+        last_line = pc.line_number_end
+        while last_line > pc.line_number_start and not document.lines[last_line - 1].strip():
+            last_line -= 1
+        react_line = f"{TODAY.strftime('%Y-%m-%d')}: {state}"
+        if document.lines[last_line - 1].endswith("\n"):
+            position = {"line": last_line, "character": 0}
+            new_text = react_line + "\n"
+        else:
+            position = {"line": last_line - 1,
+                        "character": lsp_line_length(document.lines[last_line - 1], self.position_encoding)}
+            new_text = "\n" + react_line
+        # The edit comes back as a didChange, and the react is applied to the
+        # database when the file is saved, just like a react typed by hand.
+        self.send_request("workspace/applyEdit", {
+            "label": f"React: {state}",
+            "edit": {"changes": {uri: [{"range": {"start": position, "end": position}, "newText": new_text}]}},
+        })
+
+    def roll(self) -> None:
+        notes = [note for note in get_notes_from_db(self.conn, fetch_note_text=False) if note.interval >= 0]
+        note = pick_note_to_review(notes, log_level=0)
+        if note is None:
+            self.send({"method": "window/showMessage", "params": {"type": 3, "message": "No notes are due."}})
+            return
+        # Prefer the location in the editor's copy of the file, which may
+        # have unsaved changes.
+        uri = Path(note.filepath).absolute().as_uri()
+        line_number = note.line_number_start
+        for document in self.documents.values():
+            for pc in document.chunks:
+                if pc.sha1sum == note.sha1sum:
+                    uri, line_number = document.uri, pc.line_number_start
+        position = {"line": line_number - 1, "character": 0}
+        self.send_request("window/showDocument", {"uri": uri, "takeFocus": True,
+                                                  "selection": {"start": position, "end": position}})
+
+    def chunk_at_line(self, document: OpenDocument, line_number: int) -> ParseChunk | None:
+        index = bisect.bisect_right([pc.line_number_start for pc in document.chunks], line_number) - 1
+        if index < 0 or document.chunks[index].line_number_end < line_number:
+            return None
+        return document.chunks[index]
+
+    def chunk_range(self, document: OpenDocument, pc: ParseChunk) -> dict:
+        line = pc.line_number_start - 1
+        length = lsp_line_length(document.lines[line], self.position_encoding) if line < len(document.lines) else 0
+        return {"start": {"line": line, "character": 0}, "end": {"line": line, "character": length}}
+
+    def due_chunks(self, document: OpenDocument) -> list[tuple[ParseChunk, Note]]:
+        result = []
+        for pc in document.chunks:
+            note = self.notes.get(pc.sha1sum)
+            if note is None or not note_is_due(note):
+                continue
+            if pc.reacts and pc.reacts[-1].date > note.last_reviewed_on:
+                # Reacted to in the editor, but not saved yet
+                continue
+            result.append((pc, note))
+        return result
+
+    @staticmethod
+    def due_message(note: Note) -> str:
+        return f"Due for review: {num_days_note_is_overdue(note)} days overdue (interval {note.interval} days, {note.note_state})"
+
+    def publish_diagnostics(self, document: OpenDocument) -> None:
+        diagnostics = [{"range": self.chunk_range(document, pc),
+                        "severity": 3,  # Information
+                        "source": "spaced-inbox",
+                        "message": self.due_message(note)}
+                       for pc, note in self.due_chunks(document)]
+        self.send({"method": "textDocument/publishDiagnostics",
+                   "params": {"uri": document.uri, "diagnostics": diagnostics}})
+
 
 if __name__ == "__main__":
     main()